@@ -1,20 +1,40 @@
 #!/usr/bin/env python2
 from __future__ import with_statement
 
+import errno
+import itertools
+import multiprocessing
 import os
+import select
 import sys
 import time
-import datetime
 import re
+import sre_constants
+import sre_parse
 import subprocess
+import threading
+from multiprocessing.pool import ThreadPool
+
+try:
+    import inotifyx
+except ImportError:
+    # inotify is Linux only, so elsewhere we fall back to polling
+    inotifyx = None
+
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
 
 # todo: don't break if java isn't on PATH
 
 """MashedPotato: An automatic JavaScript and CSS minifier
 
-A monitor tool which checks JS and CSS files every second and
-reminifies them if they've changed. Just leave it running, monitoring
-your directories.
+A monitor tool which watches JS and CSS files and reminifies them
+when they change. Just leave it running, monitoring your directories.
+
+On Linux, install inotifyx and we'll be told as soon as a file is
+saved. Otherwise we check the files every second.
 
 Specify a .mash file in your root directory to tell MashedPotato which
 directories to monitor. See .mash_example for an example.
@@ -32,27 +52,46 @@ $ ./tests
 # paths/error times of files we failed to minify
 error_files = {}
 
+# the paths currently listed in MASH_ERRORS, or None if we haven't
+# written it yet this run
+logged_error_files = None
+
+# minifiers run on a thread pool, so only let one at a time tell the
+# user or update error_files
+report_lock = threading.Lock()
+
+# longest we'll wait for a set of files to minify, in seconds
+MAX_MINIFY_WAIT = 60 * 60
+
+# when using inotify, how often we rescan everything anyway, in seconds
+RESCAN_INTERVAL = 60
+
 class MinifyFailed(Exception): pass
 
+# (command line, error message) when a minifier couldn't be run at all
+class MinifierNotRunnable(Exception): pass
+
 
 def get_paths_from_configuration(project_path, configuration_file):
     """Given a the contents of a configuration file, return a list of
-    regular expressions that match absolute paths according to that
+    compiled regular expressions that match absolute paths according to that
     configuration.
 
     """
     path_regexps = []
 
-    for (line_number, line) in enumerate(configuration_file.split('\n')):
+    for (line_number, line) in enumerate(configuration_file.splitlines()):
         line = line.strip()
 
-        if line and not line.startswith('#'):
-            if line.endswith('/'):
-                print("Warning: directory regexps must not end with '/'. "
-                      "Line %d will not do anything." % (line_number + 1))
-                                                      # lines are zero-indexed
-            else:
-                path_regexps.append(get_path_regexp(project_path, line))
+        if not line or line.startswith('#'):
+            continue
+
+        if line.endswith('/'):
+            print("Warning: directory regexps must not end with '/'. "
+                  "Line %d will not do anything." % (line_number + 1))
+                                                  # lines are zero-indexed
+        else:
+            path_regexps.append(get_path_regexp(project_path, line))
 
     return path_regexps
 
@@ -61,45 +100,153 @@ def get_path_regexp(project_path, relative_regexp):
     """Convert a path regexp accepted by mashed_potato to a regular
     expression which matches an absolute path.
 
-    >>> get_path_regexp("/home/wilfred/gxbo", "foo/{a,b}")
+    >>> get_path_regexp("/home/wilfred/gxbo", "foo/{a,b}").pattern
     '^/home/wilfred/gxbo/foo/{a,b}$'
 
     """
     absolute_regexp = os.path.join(project_path, relative_regexp)
     absolute_regexp = absolute_regexp.replace('\\', '/')
 
-    return "^%s$" % absolute_regexp
+    return re.compile("^%s$" % absolute_regexp)
+
+
+def combine_path_regexps(path_regexps):
+    """Fuse a list of path regexps into a single equivalent regexp, so
+    matching a path is one call into the regexp engine however many
+    lines the .mash file has. We still return a list, so the result
+    can be used anywhere path_regexps are.
+
+    >>> regexps = [re.compile("^/a$"), re.compile("^/b/(c|d)$")]
+    >>> [regexp.pattern for regexp in combine_path_regexps(regexps)]
+    ['(?:^/a$)|(?:^/b/(c|d)$)']
+
+    """
+    if not path_regexps:
+        return []
+
+    # inline flags like (?i) apply to the whole pattern, so fusing
+    # would leak one line's flags into the others
+    if len(set(regexp.flags for regexp in path_regexps)) > 1:
+        return path_regexps
+
+    # keep each regexp whole, so an unbracketed | in a .mash line
+    # means the same thing it would on its own
+    alternatives = ["(?:%s)" % regexp.pattern for regexp in path_regexps]
+
+    try:
+        return [re.compile("|".join(alternatives))]
+    except re.error:
+        # e.g. more groups in total than python's re supports
+        return path_regexps
+
+
+def get_literal_prefix(path_regexp):
+    """Return a string that every path matched by this regexp starts
+    with. This is everything before the first regexp syntax, so we can
+    rule out paths with a plain string comparison.
+
+    >>> get_literal_prefix(re.compile("^/home/wilfred/static/(js|css)$"))
+    '/home/wilfred/static/'
+    >>> get_literal_prefix(re.compile("^/home/wilfred/static/jsx?$"))
+    '/home/wilfred/static/js'
+
+    """
+    if path_regexp.flags & re.IGNORECASE:
+        return ''
+
+    prefix = []
+
+    # let python's own regexp parser deal with escapes, quantifiers
+    # and alternation for us
+    for op, argument in sre_parse.parse(path_regexp.pattern):
+        if op == sre_constants.AT and argument == sre_constants.AT_BEGINNING:
+            continue
+        elif op == sre_constants.LITERAL:
+            prefix.append(chr(argument))
+        else:
+            break
+
+    return ''.join(prefix)
+
+
+def may_contain_matches(path, literal_prefixes):
+    """Could this directory, or any directory under it, match a regexp
+    with one of these literal prefixes?
+
+    >>> may_contain_matches("/a/static", ["/a/static/js"])
+    True
+    >>> may_contain_matches("/a/templates", ["/a/static/js"])
+    False
+
+    """
+    path = path.replace('\\', '/')
+    return any(path.startswith(prefix) or prefix.startswith(path + '/')
+               for prefix in literal_prefixes)
+
+
+def get_literal_path(path_regexp):
+    """If this regexp can only match one path, return it. Otherwise
+    return None.
+
+    >>> get_literal_path(re.compile("^/home/wilfred/static/js$"))
+    '/home/wilfred/static/js'
+    >>> print get_literal_path(re.compile("^/home/wilfred/static/(js|css)$"))
+    None
+
+    """
+    prefix = get_literal_prefix(path_regexp)
+
+    if path_regexp.pattern == "^%s$" % prefix:
+        return prefix
+
+    return None
+
+
+def split_literal_paths(path_regexps):
+    """Most .mash lines are just a directory name, with no regexp
+    syntax at all. Return a set of those paths, so we can look them up
+    directly, and a list of the regexps that remain.
+
+    """
+    literal_paths = set()
+    remaining_regexps = []
+
+    for path_regexp in path_regexps:
+        literal_path = get_literal_path(path_regexp)
+
+        if literal_path is None:
+            remaining_regexps.append(path_regexp)
+        else:
+            literal_paths.add(literal_path)
 
+    return frozenset(literal_paths), remaining_regexps
 
-def path_matches_regexps(path, path_regexps):
-    """Test whether this path matches any of the given regular expressions.
+
+def path_matches_regexps(path, path_regexps, literal_paths=frozenset()):
+    """Test whether this path matches any of the given regular
+    expressions, or is one of literal_paths.
     """
     path = path.replace('\\', '/')
-    return any(re.match(regexp, path) for regexp in path_regexps)
+    return path in literal_paths or \
+        any(regexp.match(path) for regexp in path_regexps)
 
 
-def is_minifiable(file_path):
-    """JS or CSS files that aren't minified or hidden.
+def is_minifiable(file_name):
+    """JS or CSS files that aren't minified or hidden. Takes just the
+    file name, not the whole path.
 
     >>> is_minifiable("foo.js"), is_minifiable("bar.css")
     (True, True)
     >>> is_minifiable("a.min.js"), is_minifiable("b.min.css")
     (False, False)
-    >>> is_minifiable("bar.gz")
-    False
+    >>> is_minifiable("bar.gz"), is_minifiable(".#foo.js")
+    (False, False)
     """
-    _, file_name = os.path.split(file_path)
-
-    if file_name.startswith('.'):
+    if file_name.startswith('.') or \
+            file_name.endswith(('.min.js', '.min.css')):
         return False
 
-    if not file_name.endswith(('.js', '.css')):
-        return False
-
-    if file_name.endswith(('.min.js', '.min.css')):
-        return False
-
-    return True
+    return file_name.endswith(('.js', '.css'))
 
 
 def get_minified_name(file_path):
@@ -117,19 +264,25 @@ def get_minified_name(file_path):
     return minified_path
 
 
-def needs_minifying(file_path):
+def needs_minifying(file_path, minified_path=None):
     """Returns false if a file already has a minified file, and the
     minified file is newer than the source. We return false on files
     that errored last time and haven't changed since.
 
+    Pass minified_path if you already know it.
+
     """
-    source_edited_time = os.path.getmtime(file_path)
+    if minified_path is None:
+        minified_path = get_minified_name(file_path)
 
-    last_minified_time = None
-    minified_file_path = get_minified_name(file_path)
+    source_edited_time = os.stat(file_path).st_mtime
 
-    if os.path.exists(minified_file_path):
-        last_minified_time = os.path.getmtime(minified_file_path)
+    # a single stat tells us both whether the minified file exists and
+    # when it was written
+    try:
+        last_minified_time = os.stat(minified_path).st_mtime
+    except OSError:
+        last_minified_time = None
 
     # don't minify if it is already minified and hasn't changed since
     if last_minified_time and last_minified_time > source_edited_time:
@@ -143,48 +296,75 @@ def needs_minifying(file_path):
     return True
 
 
+# tools we've already looked for on PATH, so we don't search it for
+# every file we minify
+installed_tools = {}
+
+
 def is_installed(name):
     """Is this tool installed and on path?
 
     """
-    for path in os.environ["PATH"].split(os.pathsep):
-        full_path = os.path.join(path, name)
-
-        if os.path.exists(full_path):
-            return True
+    if name not in installed_tools:
+        installed_tools[name] = any(
+            os.path.exists(os.path.join(path, name))
+            for path in os.environ["PATH"].split(os.pathsep))
 
-    return False
+    return installed_tools[name]
 
 
-def minify(file_path):
+def minify(file_path, minified_path=None):
     """Create a minified JS or CSS file of the file at file_path.
 
     For JS we use uglifyjs if it's available, since the compression is
     better. CSS always uses YUICompressor.
 
     """
+    if minified_path is None:
+        minified_path = get_minified_name(file_path)
+
     if file_path.endswith(".js") and is_installed('uglifyjs'):
         # strip comments at the start:
-        command_line = "uglifyjs -nc %s > %s" % \
-            (file_path, get_minified_name(file_path))
+        command = ['uglifyjs', '-nc', file_path]
     else:
         mashed_potato_path = os.path.dirname(os.path.abspath(__file__))
-        command_line = 'java -jar %s/yuicompressor-2.4.5.jar %s > %s' % \
-            (mashed_potato_path, file_path, get_minified_name(file_path))
+        jar_path = os.path.join(mashed_potato_path, 'yuicompressor-2.4.5.jar')
+        command = ['java', '-jar', jar_path, file_path]
+
+    with open(minified_path, 'wb') as minified_file:
+        try:
+            close_fds = (sys.platform != 'win32')
+            process = subprocess.Popen(
+                command, stdout=minified_file, stderr=subprocess.PIPE,
+                close_fds=close_fds)
+        except OSError, e:
+            # we're on a worker thread, so leave it to the main thread to
+            # tell the user and exit
+            raise MinifierNotRunnable(" ".join(command), e.strerror)
+
+        _, error = process.communicate()
+
+    if error or process.returncode:
+        raise MinifyFailed()
 
-    try:
-        close_fds = (sys.platform != 'win32')
-        p = subprocess.Popen(
-            command_line, shell=True, stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE, close_fds=close_fds)
-    except OSError, e:
-        print "\nAn error occured running\n%s\n" % command_line
-        print e.strerror
-        sys.exit()
 
-    error = p.stderr.read()
-    if error:
-        raise MinifyFailed()
+def create_temporary_file(directory, prefix):
+    """Create a new, uniquely named file in this directory and return
+    its file descriptor and path. Unlike tempfile.mkstemp, the file
+    gets the usual permissions according to the user's umask.
+
+    """
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+
+    for attempt in itertools.count():
+        temp_path = os.path.join(directory, '%s.%d.%d' % (prefix, os.getpid(),
+                                                          attempt))
+        try:
+            return os.open(temp_path, flags, 0666), temp_path
+        except OSError, e:
+            # left over from an earlier run, try another name
+            if e.errno != errno.EEXIST:
+                raise
 
 
 def update_error_logs(errored, path):
@@ -194,6 +374,8 @@ def update_error_logs(errored, path):
     If nothing has errored, remove the file entirely.
 
     """
+    global logged_error_files
+
     if errored:
         error_files[path] = time.time()
     else:
@@ -201,54 +383,443 @@ def update_error_logs(errored, path):
         if path in error_files:
             del error_files[path]
 
+    # MASH_ERRORS only lists paths, so there's nothing to do unless a
+    # file has started or stopped erroring
+    if logged_error_files == set(error_files):
+        return
+
     # update MASH_ERRORS so it records the files that are currently erroring
     error_file_path = os.path.join(project_path, 'MASH_ERRORS')
 
     if error_files:
-        with open(error_file_path, 'wb') as error_log:
+        # write to a temporary file and move it into place, so nobody
+        # reading MASH_ERRORS sees it half written
+        temp_fd, temp_path = create_temporary_file(project_path,
+                                                   '.MASH_ERRORS')
+        with os.fdopen(temp_fd, 'wb') as error_log:
             for file_path in error_files.keys():
                 error_log.write('%s\n' % file_path)
 
+        # windows won't rename over an existing file
+        if sys.platform == 'win32' and os.path.exists(error_file_path):
+            os.remove(error_file_path)
+        os.rename(temp_path, error_file_path)
+
     else:
         if os.path.exists(error_file_path):
             os.remove(error_file_path)
 
+    logged_error_files = set(error_files)
 
-def all_monitored_files(path_regexps, project_path):
-    """For all the subdirectories in this path which match a
-    path_regexp, return a list of their files and paths.
+
+def all_monitored_directories(path_regexps, project_path):
+    """Return every subdirectory of project_path which matches a
+    path_regexp.
 
     """
     assert os.path.isabs(project_path), "project_path should be absolute"
 
+    literal_prefixes = [get_literal_prefix(regexp) for regexp in path_regexps]
+    literal_paths, path_regexps = split_literal_paths(path_regexps)
+    path_regexps = combine_path_regexps(path_regexps)
+
     for subdirectory_path, subdirectories, files in os.walk(project_path):
-        if path_matches_regexps(subdirectory_path, path_regexps):
+        if path_matches_regexps(subdirectory_path, path_regexps,
+                                literal_paths):
+            yield subdirectory_path
+
+        # don't descend into directories that can't contain a match
+        subdirectories[:] = [
+            subdirectory for subdirectory in subdirectories
+            if may_contain_matches(
+                os.path.join(subdirectory_path, subdirectory),
+                literal_prefixes)]
+
+
+def minify_and_log(paths):
+    """Minify a file, given as a (file path, minified path) pair,
+    telling the user how it went and recording it in MASH_ERRORS if it
+    failed. This runs on a thread pool, see minify_files.
+
+    """
+    file_path, minified_path = paths
+
+    try:
+        minify(file_path, minified_path)
+
+        with report_lock:
+            # inform the user:
+            print "[%s] Minified %s" % (time.strftime('%H:%M:%S'), file_path)
+
+            update_error_logs(False, file_path)
+
+    except MinifyFailed:
+        with report_lock:
+            print "Error minifying %s" % file_path
+            update_error_logs(True, file_path)
+
+
+def files_needing_minifying(directory):
+    """Return every file in this directory (but not its
+    subdirectories) which has changed since we last minified it, as
+    (file path, minified path) pairs.
+
+    """
+    if scandir:
+        # scandir can usually tell files from directories without a stat
+        file_paths = [entry.path for entry in scandir(directory)
+                      if is_minifiable(entry.name) and entry.is_file()]
+    else:
+        file_paths = [os.path.join(directory, file_name)
+                      for file_name in os.listdir(directory)
+                      if is_minifiable(file_name)]
+        file_paths = filter(os.path.isfile, file_paths)
+
+    return select_files_to_minify(file_paths)
 
-            # this directory matches, so yield all its contents
-            for file_name in files:
-                file_path = os.path.join(subdirectory_path, file_name)
-                yield file_path
+
+def select_files_to_minify(file_paths):
+    """Return a (file path, minified path) pair for each of these files
+    which needs minifying. We work out the minified path once here and
+    pass it along, rather than every function deriving it again.
+
+    """
+    files_to_minify = []
+
+    for file_path in file_paths:
+        minified_path = get_minified_name(file_path)
+
+        try:
+            if needs_minifying(file_path, minified_path):
+                files_to_minify.append((file_path, minified_path))
+        except OSError, e:
+            # it's been deleted since we found it
+            if e.errno != errno.ENOENT:
+                raise
+
+    return files_to_minify
+
+
+def scan_directories(directories):
+    """Return the files in these directories which need minifying, as
+    (file path, minified path) pairs, and a list of the directories
+    that no longer exist.
+
+    """
+    files_to_minify = []
+    missing_directories = []
+
+    for directory in directories:
+        try:
+            files_to_minify.extend(files_needing_minifying(directory))
+        except OSError, e:
+            if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
+            missing_directories.append(directory)
+
+    return files_to_minify, missing_directories
+
+
+def minify_all_in_directories(directories, pool):
+    """Minify every file in these directories which has changed since
+    we last minified it.
+
+    Each minifier spends its time waiting on a separate process, so we
+    run them on a thread pool and wait for the slowest rather than for
+    all of them in turn.
+
+    """
+    files_to_minify, _ = scan_directories(directories)
+    minify_files(files_to_minify, pool)
+
+
+def minify_files(files_to_minify, pool):
+    """Minify these (file path, minified path) pairs on this thread
+    pool, and wait until they're all done.
+
+    """
+    # waiting with a timeout means Ctrl-C still works in Python 2
+    try:
+        pool.map_async(minify_and_log, files_to_minify).get(MAX_MINIFY_WAIT)
+    except multiprocessing.TimeoutError:
+        print "Gave up waiting for minifiers after %d seconds." % \
+            MAX_MINIFY_WAIT
 
 
 def continually_monitor_files(path_regexps, project_path):
+    """Poll the monitored directories every second. We only use this
+    where inotify isn't available, see ContinualMinifier.
+
+    """
+    pool = ThreadPool(multiprocessing.cpu_count())
+
     while True:
-        for file_path in all_monitored_files(path_regexps, project_path):
-            if is_minifiable(file_path) and needs_minifying(file_path):
-                try:
-                    minify(file_path)
+        minify_all_in_directories(
+            all_monitored_directories(path_regexps, project_path), pool)
 
-                    # inform the user:
-                    now_time = datetime.datetime.now().time()
-                    pretty_now_time = str(now_time).split('.')[0]
-                    print "[%s] Minified %s" % (pretty_now_time, file_path)
+        time.sleep(1)
 
-                    update_error_logs(False, file_path)
 
-                except MinifyFailed:
-                    print "Error minifying %s" % file_path
-                    update_error_logs(True, file_path)
+class ContinualMinifier(object):
+    """Minify files in the monitored directories as soon as they
+    change. Rather than polling, we wait on inotify until a file in
+    one of those directories has been written to, then only look at
+    the files that changed.
 
-        time.sleep(1)
+    """
+    def __init__(self, path_regexps, project_path):
+        self.inotify_handle = inotifyx.init()
+        self.path_regexps = path_regexps
+        self.project_path = project_path
+
+        # watch descriptors to the directory they're watching, and back
+        self._watches = {}
+        self._dir_to_wd = {}
+
+        for directory in all_monitored_directories(path_regexps,
+                                                   project_path):
+            self._watch_directory(directory)
+
+        # writing to this pipe wakes up continually_monitor_files, so
+        # stop() can be called from another thread or a signal handler
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        self._stopped = False
+
+        self._epoll = select.epoll()
+        self._epoll.register(self.inotify_handle, select.EPOLLIN)
+        self._epoll.register(self._wakeup_read, select.EPOLLIN)
+
+        self._pool = ThreadPool(multiprocessing.cpu_count())
+
+    @property
+    def monitored_directories(self):
+        return self._dir_to_wd.keys()
+
+    def _watch_directory(self, directory):
+        """Watch this directory, returning True if we weren't already
+        watching the directory that's at this path.
+
+        """
+        # we care about files that have been written to or moved into
+        # this directory, new subdirectories, and the directory itself
+        # being moved away. IN_ONLYDIR makes sure a file that's taken
+        # the directory's place isn't watched by mistake.
+        mask = (inotifyx.IN_CLOSE_WRITE | inotifyx.IN_MOVED_TO |
+                inotifyx.IN_CREATE | inotifyx.IN_MOVE_SELF |
+                inotifyx.IN_ONLYDIR)
+        try:
+            watch_descriptor = inotifyx.add_watch(self.inotify_handle,
+                                                  directory, mask)
+        except IOError, e:
+            # it's been removed since we found it
+            if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
+            return False
+
+        if self._dir_to_wd.get(directory) == watch_descriptor:
+            return False
+
+        # inotify gives us the existing watch if this directory has
+        # been renamed, so forget its old name
+        old_directory = self._watches.get(watch_descriptor)
+        if old_directory is not None:
+            del self._dir_to_wd[old_directory]
+
+        # a different directory used to be at this path, and it's been
+        # moved somewhere else
+        old_watch_descriptor = self._dir_to_wd.get(directory)
+        if old_watch_descriptor is not None:
+            del self._watches[old_watch_descriptor]
+            self._remove_watch(old_watch_descriptor)
+
+        self._watches[watch_descriptor] = directory
+        self._dir_to_wd[directory] = watch_descriptor
+        return True
+
+    def _unwatch_directory(self, directory):
+        watch_descriptor = self._dir_to_wd.pop(directory)
+        del self._watches[watch_descriptor]
+        self._remove_watch(watch_descriptor)
+
+    def _remove_watch(self, watch_descriptor):
+        try:
+            inotifyx.rm_watch(self.inotify_handle, watch_descriptor)
+        except IOError, e:
+            # the kernel has already removed it
+            if e.errno != errno.EINVAL:
+                raise
+
+    def _forget_watch(self, watch_descriptor):
+        """The kernel has removed this watch (e.g. the directory was
+        deleted), so stop tracking it.
+
+        """
+        directory = self._watches.pop(watch_descriptor, None)
+        if directory is not None:
+            del self._dir_to_wd[directory]
+
+    def _watch_new_directories(self, directory):
+        """Start monitoring any directories at or under this path that
+        we aren't already. Return the ones we're now monitoring.
+
+        """
+        new_directories = []
+        for subdirectory in all_monitored_directories(self.path_regexps,
+                                                      directory):
+            if self._watch_directory(subdirectory):
+                new_directories.append(subdirectory)
+        return new_directories
+
+    def _drain_events(self):
+        """Return all the events inotify has queued up, without blocking.
+
+        """
+        events = []
+        while True:
+            new_events = inotifyx.get_events(self.inotify_handle, 0)
+            if not new_events:
+                return events
+            events.extend(new_events)
+
+    def _process_events(self, events):
+        """Update our watches according to these events. Return the
+        minifiable files that have been written to, any directories
+        we've started monitoring, and whether inotify dropped events.
+
+        """
+        changed_files = set()
+        new_directories = []
+        overflowed = False
+
+        for event in events:
+            if event.mask & inotifyx.IN_Q_OVERFLOW:
+                overflowed = True
+                continue
+
+            if event.mask & inotifyx.IN_IGNORED:
+                self._forget_watch(event.wd)
+                continue
+
+            directory = self._watches.get(event.wd)
+            if directory is None:
+                # we've already stopped watching it
+                continue
+
+            if event.mask & inotifyx.IN_MOVE_SELF:
+                if os.path.isdir(directory):
+                    # either we've already followed the rename, or
+                    # there's a new directory at this path to watch
+                    if self._watch_directory(directory):
+                        new_directories.append(directory)
+                else:
+                    # it's moved elsewhere, so may no longer match, and
+                    # nor may anything under it
+                    self._unwatch_directory(directory)
+                    for subdirectory in self._dir_to_wd.keys():
+                        if subdirectory.startswith(directory + os.sep):
+                            self._unwatch_directory(subdirectory)
+
+            elif event.mask & inotifyx.IN_ISDIR:
+                if event.mask & (inotifyx.IN_CREATE | inotifyx.IN_MOVED_TO):
+                    new_directory = os.path.join(directory, event.name)
+                    new_directories.extend(
+                        self._watch_new_directories(new_directory))
+
+            elif event.mask & (inotifyx.IN_CLOSE_WRITE |
+                               inotifyx.IN_MOVED_TO):
+                if is_minifiable(event.name):
+                    changed_files.add(os.path.join(directory, event.name))
+
+        return changed_files, new_directories, overflowed
+
+    def _scan_directories(self, directories):
+        """Return the files in these directories which need minifying,
+        forgetting any of the directories that have gone away.
+
+        """
+        files_to_minify, missing_directories = scan_directories(directories)
+
+        for directory in missing_directories:
+            if directory in self._dir_to_wd:
+                self._unwatch_directory(directory)
+
+        return files_to_minify
+
+    def _files_to_minify(self, events):
+        """Update our watches according to these events, and return the
+        files which need minifying as a result.
+
+        """
+        changed_files, new_directories, overflowed = \
+            self._process_events(events)
+
+        if overflowed:
+            # inotify dropped events, so we don't know what changed
+            return self._scan_directories(self.monitored_directories)
+
+        # we scan new directories in full, so don't minify their files
+        # twice
+        new_directories = set(new_directories)
+        changed_files = [file_path for file_path in changed_files
+                         if os.path.dirname(file_path) not in new_directories]
+
+        # inotify has told us exactly which files changed, so there's no
+        # need to look at anything else in their directories
+        files_to_minify = select_files_to_minify(
+            filter(os.path.isfile, changed_files))
+        files_to_minify.extend(self._scan_directories(new_directories))
+
+        return files_to_minify
+
+    def minify_all(self):
+        minify_files(self._scan_directories(self.monitored_directories),
+                     self._pool)
+
+    def continually_monitor_files(self):
+        # catch up on anything that changed while we weren't running
+        self.minify_all()
+
+        next_rescan = time.time() + RESCAN_INTERVAL
+
+        while not self._stopped:
+            try:
+                ready = self._epoll.poll(max(next_rescan - time.time(), 0))
+            except IOError, e:
+                # interrupted by a signal, just wait again
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+
+            if self._stopped:
+                break
+
+            if ready:
+                events = self._drain_events()
+                minify_files(self._files_to_minify(events), self._pool)
+
+            # every so often, catch anything inotify can't tell us
+            # about, such as matching directories created outside the
+            # ones we watch. We do this even if events keep arriving,
+            # since every minify we do is an event itself.
+            if time.time() >= next_rescan:
+                self._watch_new_directories(self.project_path)
+                self.minify_all()
+                next_rescan = time.time() + RESCAN_INTERVAL
+
+    def stop(self):
+        """Make continually_monitor_files return. Safe to call from
+        another thread.
+
+        """
+        self._stopped = True
+        os.write(self._wakeup_write, 'x')
+
+    def close(self):
+        self._pool.terminate()
+        self._epoll.close()
+        os.close(self._wakeup_read)
+        os.close(self._wakeup_write)
+        os.close(self.inotify_handle)
 
 
 if __name__ == '__main__':
@@ -280,6 +851,15 @@ if __name__ == '__main__':
     print ""
 
     try:
-        continually_monitor_files(path_regexps, project_path)
+        if inotifyx:
+            minifier = ContinualMinifier(path_regexps, project_path)
+            minifier.continually_monitor_files()
+        else:
+            continually_monitor_files(path_regexps, project_path)
+    except MinifierNotRunnable, e:
+        command_line, error_message = e.args
+        print "\nAn error occured running\n%s\n" % command_line
+        print error_message
+        sys.exit()
     except KeyboardInterrupt:
         print ""  # for tidyness' sake
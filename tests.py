@@ -7,10 +7,15 @@ import shutil
 import unittest
 import tempfile
 import textwrap
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 import mashed_potato
 
 get_paths_from_configuration = mashed_potato.get_paths_from_configuration
 path_matches_regexps = mashed_potato.path_matches_regexps
+combine_path_regexps = mashed_potato.combine_path_regexps
+split_literal_paths = mashed_potato.split_literal_paths
 
 class MinifyTest(unittest.TestCase):
     FIXTURES = {
@@ -42,6 +47,29 @@ body {
             minified_name = mashed_potato.get_minified_name(file_path)
             self.assertTrue(os.path.exists(minified_name))
 
+    def test_missing_minifier(self):
+        # nothing is on PATH, but pretend we found uglifyjs
+        old_path = os.environ["PATH"]
+        os.environ["PATH"] = self._temp_dir
+        mashed_potato.installed_tools["uglifyjs"] = True
+        js_path = os.path.join(self._temp_dir, "test.js")
+
+        try:
+            self.assertRaises(mashed_potato.MinifierNotRunnable,
+                              mashed_potato.minify, js_path)
+
+            # the error reaches us from the thread pool, rather than
+            # the pool waiting forever
+            pool = ThreadPool(1)
+            files_to_minify = mashed_potato.select_files_to_minify([js_path])
+            self.assertRaises(mashed_potato.MinifierNotRunnable,
+                              mashed_potato.minify_files,
+                              files_to_minify, pool)
+            pool.terminate()
+        finally:
+            os.environ["PATH"] = old_path
+            del mashed_potato.installed_tools["uglifyjs"]
+
     def tearDown(self):
         shutil.rmtree(self._temp_dir)
 
@@ -58,6 +86,16 @@ class ConfigurationTest(unittest.TestCase):
         path_regexps = get_paths_from_configuration("/", "foo\nbar\nbaz")
         self.assertEqual(len(path_regexps), 3)
 
+    def test_windows_line_endings(self):
+        path_regexps = get_paths_from_configuration("/", "foo\r\n# bar\r\nbaz")
+        self.assertEqual([regexp.pattern for regexp in path_regexps],
+                         ['^/foo$', '^/baz$'])
+
+    def test_regexps_are_absolute(self):
+        path_regexps = get_paths_from_configuration("/home/foo", "bar\nbaz")
+        self.assertEqual([regexp.pattern for regexp in path_regexps],
+                         ['^/home/foo/bar$', '^/home/foo/baz$'])
+
 
 class RegexpMatchingTest(unittest.TestCase):
     def test_simple_regexp(self):
@@ -68,6 +106,242 @@ class RegexpMatchingTest(unittest.TestCase):
         path_regexps = get_paths_from_configuration("/", "abc/[^/]+/ghi")
         self.assertTrue(path_matches_regexps("/abc/def/ghi", path_regexps))
 
+    def test_literal_paths(self):
+        path_regexps = get_paths_from_configuration("/", "foo\nbar/(a|b)")
+        literal_paths, path_regexps = split_literal_paths(path_regexps)
+        self.assertEqual(literal_paths, frozenset(["/foo"]))
+        self.assertEqual(len(path_regexps), 1)
+
+        self.assertTrue(
+            path_matches_regexps("/foo", path_regexps, literal_paths))
+        self.assertTrue(
+            path_matches_regexps("/bar/a", path_regexps, literal_paths))
+        self.assertFalse(
+            path_matches_regexps("/foo/a", path_regexps, literal_paths))
+
+    def test_combined_regexps_keep_flags_separate(self):
+        path_regexps = get_paths_from_configuration("/", "Stat[i]c\n(?i)j[s]")
+        path_regexps = combine_path_regexps(path_regexps)
+        self.assertEqual(len(path_regexps), 2)
+
+        self.assertFalse(path_matches_regexps("/static", path_regexps))
+        self.assertTrue(path_matches_regexps("/Static", path_regexps))
+        self.assertTrue(path_matches_regexps("/JS", path_regexps))
+
+    def test_combined_regexps(self):
+        path_regexps = get_paths_from_configuration("/", "foo\nbar/(a|b)")
+        path_regexps = combine_path_regexps(path_regexps)
+        self.assertEqual(len(path_regexps), 1)
+
+        self.assertTrue(path_matches_regexps("/foo", path_regexps))
+        self.assertTrue(path_matches_regexps("/bar/b", path_regexps))
+        self.assertFalse(path_matches_regexps("/foo/bar", path_regexps))
+        self.assertFalse(path_matches_regexps("/bar", path_regexps))
+
+class MonitoredDirectoriesTest(unittest.TestCase):
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp()
+        for directory in ["static/js/libs", "static/css", "templates/js"]:
+            os.makedirs(os.path.join(self._temp_dir, directory))
+
+    def test_only_matching_directories(self):
+        path_regexps = get_paths_from_configuration(
+            self._temp_dir, "static/js\nstatic/[^/]+/libs")
+        directories = mashed_potato.all_monitored_directories(
+            path_regexps, self._temp_dir)
+
+        self.assertEqual(
+            sorted(directories),
+            [os.path.join(self._temp_dir, "static/js"),
+             os.path.join(self._temp_dir, "static/js/libs")])
+
+    def tearDown(self):
+        shutil.rmtree(self._temp_dir)
+
+class ErrorLogTest(unittest.TestCase):
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp()
+        self.error_log_path = os.path.join(self._temp_dir, "MASH_ERRORS")
+
+        mashed_potato.project_path = self._temp_dir
+        mashed_potato.error_files.clear()
+        mashed_potato.logged_error_files = None
+
+    def test_unchanged_errors_not_rewritten(self):
+        mashed_potato.update_error_logs(True, "/a.js")
+        with open(self.error_log_path) as error_log:
+            self.assertEqual(error_log.read(), "/a.js\n")
+
+        # we replace the file rather than writing into it, so a new
+        # inode means it was rewritten
+        inode = os.stat(self.error_log_path).st_ino
+        mashed_potato.update_error_logs(True, "/a.js")
+        mashed_potato.update_error_logs(False, "/b.js")
+        self.assertEqual(os.stat(self.error_log_path).st_ino, inode)
+
+        mashed_potato.update_error_logs(True, "/b.js")
+        self.assertNotEqual(os.stat(self.error_log_path).st_ino, inode)
+
+    def test_removed_when_nothing_errors(self):
+        mashed_potato.update_error_logs(True, "/a.js")
+        mashed_potato.update_error_logs(False, "/a.js")
+        self.assertFalse(os.path.exists(self.error_log_path))
+        self.assertEqual(os.listdir(self._temp_dir), [])
+
+    def test_permissions_follow_umask(self):
+        mashed_potato.update_error_logs(True, "/a.js")
+        umask = os.umask(0)
+        os.umask(umask)
+
+        mode = os.stat(self.error_log_path).st_mode & 0777
+        self.assertEqual(mode, 0666 & ~umask)
+
+    def tearDown(self):
+        mashed_potato.error_files.clear()
+        mashed_potato.logged_error_files = None
+        del mashed_potato.project_path
+        shutil.rmtree(self._temp_dir)
+
+@unittest.skipIf(mashed_potato.inotifyx is None, "needs inotifyx")
+class ContinualMinifierTest(unittest.TestCase):
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self._temp_dir, "static/js/sub"))
+
+        path_regexps = get_paths_from_configuration(
+            self._temp_dir, "static/js\nstatic/js/[^/]+")
+        self.minifier = mashed_potato.ContinualMinifier(path_regexps,
+                                                        self._temp_dir)
+
+    def path(self, relative_path):
+        return os.path.join(self._temp_dir, relative_path)
+
+    def process_events(self):
+        return self.minifier._process_events(self.minifier._drain_events())
+
+    def assertWatching(self, relative_paths):
+        directories = sorted(self.path(path) for path in relative_paths)
+        self.assertEqual(sorted(self.minifier._dir_to_wd.keys()),
+                         directories)
+        self.assertEqual(sorted(self.minifier._watches.values()),
+                         directories)
+
+    def write(self, relative_path, contents="var a;"):
+        with open(self.path(relative_path), "w") as source_file:
+            source_file.write(contents)
+
+    def files_to_minify(self, events=None):
+        if events is None:
+            events = self.minifier._drain_events()
+        return sorted(file_path for file_path, _ in
+                      self.minifier._files_to_minify(events))
+
+    def test_only_changed_files(self):
+        self.write("static/js/old.js")
+        self.minifier._drain_events()
+
+        self.write("static/js/a.js")
+        self.write("static/js/b.min.js")
+        self.write("static/js/notes.txt")
+        self.write("static/js/sub/c.css")
+
+        # old.js needs minifying, but inotify didn't mention it
+        self.assertEqual(self.files_to_minify(),
+                         [self.path("static/js/a.js"),
+                          self.path("static/js/sub/c.css")])
+
+    def test_new_directory_scanned(self):
+        os.mkdir(self.path("static/js/new"))
+        # written before we've had a chance to watch the directory
+        self.write("static/js/new/a.js")
+
+        self.assertEqual(self.files_to_minify(),
+                         [self.path("static/js/new/a.js")])
+        self.assertWatching(["static/js", "static/js/sub",
+                             "static/js/new"])
+
+    def test_overflow_rescans_everything(self):
+        self.write("static/js/a.js")
+        self.write("static/js/sub/b.js")
+        self.minifier._drain_events()
+
+        overflow = mashed_potato.inotifyx.InotifyEvent(
+            -1, mashed_potato.inotifyx.IN_Q_OVERFLOW, 0, None)
+        self.assertEqual(self.files_to_minify([overflow]),
+                         [self.path("static/js/a.js"),
+                          self.path("static/js/sub/b.js")])
+
+    def test_rename_to_matching_name(self):
+        os.rename(self.path("static/js/sub"), self.path("static/js/sub2"))
+        self.process_events()
+        self.assertWatching(["static/js", "static/js/sub2"])
+
+        # the old name can be reused
+        os.mkdir(self.path("static/js/sub"))
+        _, new_directories, _ = self.process_events()
+        self.assertEqual(new_directories, [self.path("static/js/sub")])
+        self.assertWatching(["static/js", "static/js/sub",
+                             "static/js/sub2"])
+
+    def test_rename_then_write(self):
+        os.rename(self.path("static/js/sub"), self.path("static/js/sub2"))
+        self.write("static/js/sub2/a.js")
+
+        self.assertEqual(self.files_to_minify(),
+                         [self.path("static/js/sub2/a.js")])
+
+    def test_watch_removed_directory(self):
+        self.assertFalse(
+            self.minifier._watch_directory(self.path("static/js/gone")))
+
+        self.write("static/js/not_a_directory")
+        self.assertFalse(self.minifier._watch_directory(
+            self.path("static/js/not_a_directory")))
+
+        self.assertWatching(["static/js", "static/js/sub"])
+
+    def test_rename_to_non_matching_name(self):
+        os.rename(self.path("static/js/sub"), self.path("static/sub"))
+        self.process_events()
+        self.assertWatching(["static/js"])
+
+    def test_rescan_forgets_deleted_directories(self):
+        # as if inotify's queue overflowed and we missed the IN_IGNORED
+        os.rmdir(self.path("static/js/sub"))
+        self.minifier._scan_directories(self.minifier.monitored_directories)
+        self.assertWatching(["static/js"])
+
+    def test_rescan_while_busy(self):
+        old_interval = mashed_potato.RESCAN_INTERVAL
+        mashed_potato.RESCAN_INTERVAL = 0.2
+        thread = threading.Thread(
+            target=self.minifier.continually_monitor_files)
+        thread.start()
+
+        try:
+            # inotify can't tell us about this, it's not in a watched
+            # directory
+            os.makedirs(self.path("lib/js"))
+            self.minifier.path_regexps = get_paths_from_configuration(
+                self._temp_dir, "static/js\nlib/js")
+
+            # keep the minifier busy for several rescan intervals
+            for _ in range(10):
+                with open(self.path("static/js/notes.txt"), "w") as notes:
+                    notes.write("busy")
+                time.sleep(0.05)
+
+            self.assertTrue(self.path("lib/js") in
+                            self.minifier.monitored_directories)
+        finally:
+            self.minifier.stop()
+            thread.join()
+            mashed_potato.RESCAN_INTERVAL = old_interval
+
+    def tearDown(self):
+        self.minifier.close()
+        shutil.rmtree(self._temp_dir)
+
 #Make doctests discoverable by unittest
 def load_tests(loader, tests, ignore):
     tests.addTests(doctest.DocTestSuite(mashed_potato))